@@ -0,0 +1,440 @@
+import argparse
+import datetime
+import math
+import multiprocessing
+import os
+import random
+import re
+import shutil
+import tempfile
+import time
+import unittest
+
+from test.support import captured_stdout
+from unittest import mock
+
+from peewee import fn
+from peewee import IntegerField
+from peewee import Model
+
+from work_log import ConsoleUI
+from work_log import db
+from work_log import Entry
+
+WORDS = ['alpha', 'bravo', 'charlie', 'delta', 'echo', 'foxtrot', 'golf', 'hotel', 'india', 'juliet']
+OPERATIONS = [('create', 3), ('open', 2), ('edit', 3), ('delete', 1), ('lookup', 3)]
+EDITABLE_FIELDS = ['created_timestamp', 'task_name', 'task_time', 'task_notes']
+SEED_EMPLOYEE = 'Stress Seed'
+MAX_OPEN_ENTRIES = 5
+BUSY_TIMEOUT = 30
+
+
+class WriteSequence(Model):
+    """Hands out commit-order numbers, one per write the stress workers make"""
+    worker = IntegerField()
+
+    class Meta:
+        database = db
+
+
+def use_database(db_path):
+    """Points the work log database at db_path, returns the previous path and connection settings"""
+    previous = db.database, dict(db.connect_kwargs)
+    db.init(db_path, timeout=BUSY_TIMEOUT)
+    return previous
+
+
+def restore_database(previous):
+    """Points the work log database back at the path and connection settings use_database() replaced"""
+    database, connect_kwargs = previous
+    db.init(database)
+    db.connect_kwargs = connect_kwargs
+
+
+def random_case(rng, text):
+    """Randomly changes the case of each letter in text"""
+    return ''.join(letter.upper() if rng.random() < 0.5 else letter.lower() for letter in text)
+
+
+def random_text(rng, words=2):
+    """Builds a random mixed-case phrase from the shared vocabulary"""
+    return ' '.join(rng.choice([str.lower, str.upper, str.title])(rng.choice(WORDS)) for _ in range(words))
+
+
+def random_timestamp(rng):
+    """Builds a random timestamp within the last few weeks"""
+    days_ago = rng.randint(0, 20)
+    seconds = rng.randint(0, 24 * 60 * 60 - 1)
+    today = datetime.datetime.combine(datetime.date.today(), datetime.time())
+    return today - datetime.timedelta(days=days_ago) + datetime.timedelta(seconds=seconds)
+
+
+def random_field_value(rng, field):
+    """Builds a new value for one of the fields the edit menu changes"""
+    if field == 'created_timestamp':
+        return random_timestamp(rng)
+    if field == 'task_time':
+        return rng.randint(1, 60)
+    return random_text(rng)
+
+
+def employee_names(workers):
+    """Every employee name the stress test writes entries for"""
+    return [SEED_EMPLOYEE] + ['Stress Worker {}'.format(number) for number in range(workers)]
+
+
+def entry_values(entry):
+    """The values of an Entry the oracle keeps track of"""
+    return dict(employee_name=entry.employee_name, task_name=entry.task_name, task_time=entry.task_time,
+                task_notes=entry.task_notes, created_timestamp=entry.created_timestamp)
+
+
+def pick_entry(rng):
+    """Picks a random stored Entry, or None when there are none"""
+    max_id = Entry.select(fn.Max(Entry.id)).scalar()
+    if max_id is None:
+        return None
+    return Entry.select().where(Entry.id >= rng.randint(1, max_id)).order_by(Entry.id).first()
+
+
+def day_span(date):
+    """The first and last second of date, the way the ConsoleUI date lookups search"""
+    return date, date + datetime.timedelta(days=1) - datetime.timedelta(seconds=1)
+
+
+def choose_lookup(rng, names, rows=None):
+    """Picks a ConsoleUI lookup, returns (description, method, inputs, brute-force predicate)
+
+    Exact date lookups need a date that has entries, so they are only picked when rows are given.
+    """
+    kinds = ['employee', 'time', 'search', 'date range'] + (['exact date'] if rows else [])
+    kind = rng.choice(kinds)
+    if kind == 'employee':
+        name = random_case(rng, rng.choice(names))
+        # a second answer settles "Multiple matches" when the name is a prefix of another employee's
+        return ('employee {!r}'.format(name), 'lookup_by_employee', [name, name],
+                lambda values: values['employee_name'].lower() == name.lower())
+    if kind == 'time':
+        task_time = rng.choice(rows)['task_time'] if rows and rng.random() < 0.8 else rng.randint(1, 60)
+        return ('task_time {}'.format(task_time), 'lookup_entries', ['t', str(task_time), 'b'],
+                lambda values: values['task_time'] == task_time)
+    if kind == 'search':
+        term = random_case(rng, rng.choice(WORDS)[:rng.randint(2, 5)])
+        return ('search {!r}'.format(term), 'lookup_entries', ['s', term, 'b'],
+                lambda values: term.lower() in values['task_name'].lower() or
+                term.lower() in values['task_notes'].lower())
+    if kind == 'exact date':
+        from_date, to_date = day_span(rng.choice(rows)['created_timestamp'].replace(hour=0, minute=0, second=0,
+                                                                                   microsecond=0))
+        return ('exact date {:%m-%d-%Y}'.format(from_date), 'lookup_entries',
+                ['d', 'e', from_date.strftime('%m-%d-%Y'), 'b'],
+                lambda values: from_date <= values['created_timestamp'] <= to_date)
+    from_date = random_timestamp(rng).replace(hour=0, minute=0, second=0)
+    last_date = from_date + datetime.timedelta(days=rng.randint(0, 3))
+    if last_date.year != from_date.year:
+        # the ConsoleUI compares MM-DD-YYYY strings, so it rejects ranges that cross a new year
+        last_date = from_date
+    to_date = day_span(last_date)[1]
+    return ('date range {:%m-%d-%Y} to {:%m-%d-%Y}'.format(from_date, last_date), 'lookup_entries',
+            ['d', 'r', from_date.strftime('%m-%d-%Y'), last_date.strftime('%m-%d-%Y'), 'b'],
+            lambda values: from_date <= values['created_timestamp'] <= to_date)
+
+
+def run_lookup(method, inputs):
+    """Drives a ConsoleUI lookup with inputs, returns the entries it would display"""
+    console = ConsoleUI()
+    found = []
+    console.display_one_at_a_time = lambda entries: found.extend(entries)
+    with mock.patch('builtins.input', side_effect=inputs), mock.patch.object(ConsoleUI, 'clear_console'), \
+            captured_stdout():
+        try:
+            getattr(console, method)()
+        except StopIteration:
+            # the ConsoleUI keeps asking when a name or date has no entries
+            pass
+    return found
+
+
+def stress_worker(args):
+    """Runs a random mix of operations against entries shared by every worker"""
+    db_path, worker_number, workers, ops_per_worker, stale_edits, seed = args
+    use_database(db_path)
+    db.connect()
+    rng = random.Random('{}-{}'.format(seed, worker_number))
+    employee_name = employee_names(workers)[worker_number + 1]
+    operations = [(name, weight) for name, weight in OPERATIONS if stale_edits or name != 'open']
+    names, weights = zip(*operations)
+
+    opened = []
+    writes = []
+    lock_waits = []
+    op_counts = {}
+
+    started = time.time()
+    for _ in range(ops_per_worker):
+        operation = rng.choices(names, weights)[0]
+
+        if operation == 'lookup':
+            # other workers keep writing, so lookups are only checked against the oracle once they finish
+            method, inputs = choose_lookup(rng, employee_names(workers))[1:3]
+            run_lookup(method, inputs)
+            op_counts[operation] = op_counts.get(operation, 0) + 1
+            continue
+
+        if operation == 'open':
+            # like display_one_at_a_time, hold on to an entry while the user decides what to do with it
+            entry = pick_entry(rng)
+            if entry is not None:
+                opened.append(entry)
+                del opened[:-MAX_OPEN_ENTRIES]
+            op_counts[operation] = op_counts.get(operation, 0) + 1
+            continue
+
+        held = None
+        if operation in ('edit', 'delete') and opened and rng.random() < 0.5:
+            held = opened.pop(rng.randrange(len(opened)))
+        field = rng.choice(EDITABLE_FIELDS)
+        value = random_field_value(rng, field)
+
+        # writes take the lock up front so the time spent waiting for it can be measured
+        waiting = time.perf_counter()
+        with db.atomic('IMMEDIATE'):
+            lock_waits.append(time.perf_counter() - waiting)
+            entry = held
+            if entry is None and operation != 'create':
+                entry = pick_entry(rng)
+                if entry is None:
+                    operation = 'create'
+            write = {'sequence': WriteSequence.create(worker=worker_number).id, 'operation': operation}
+            if operation == 'create':
+                entry = Entry.create(employee_name=employee_name, task_name=random_text(rng),
+                                     task_time=rng.randint(1, 60), task_notes=random_text(rng, words=3))
+                write.update(entry_id=entry.id, values=entry_values(entry), rows=1)
+            elif operation == 'edit':
+                setattr(entry, field, value)
+                write.update(entry_id=entry.id, values={field: value}, rows=entry.save())
+            else:
+                write.update(entry_id=entry.id, values={}, rows=entry.delete_instance())
+        writes.append(write)
+        counted = 'stale ' + operation if held is not None else operation
+        op_counts[counted] = op_counts.get(counted, 0) + 1
+    finished = time.time()
+    db.close()
+
+    return {'writes': writes, 'lock_waits': lock_waits, 'op_counts': op_counts, 'started': started,
+            'finished': finished}
+
+
+def replay_writes(model, writes):
+    """Applies writes to model in commit order, each edit changing only the field it set
+
+    Returns failure messages for writes that touched the wrong number of rows.
+    """
+    failures = []
+    for write in sorted(writes, key=lambda write: write['sequence']):
+        entry_id = write['entry_id']
+        if write['operation'] == 'create':
+            if entry_id in model:
+                failures.append('entry id {} was handed out twice'.format(entry_id))
+            model[entry_id] = dict(write['values'])
+            continue
+        expected_rows = 1 if entry_id in model else 0
+        if write['rows'] != expected_rows:
+            failures.append('{} of entry {} changed {} rows, expected {}'.format(write['operation'], entry_id,
+                                                                             write['rows'], expected_rows))
+        if entry_id not in model:
+            continue
+        if write['operation'] == 'edit':
+            model[entry_id].update(write['values'])
+        else:
+            del model[entry_id]
+    return failures
+
+
+def percentile(values, percent):
+    """Nearest-rank percentile of values"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(int(math.ceil(percent / 100.0 * len(ordered))), 1)
+    return ordered[rank - 1]
+
+
+def run_stress_test(db_path, workers=4, ops_per_worker=200, seed_entries=0, lookups=50, stale_edits=False,
+                    seed=None):
+    """Hammers a fresh database at db_path from several processes, then checks the results against an oracle
+
+    With stale_edits, workers also edit and delete entries they loaded earlier, the way the ConsoleUI does.
+    """
+    seed = random.randrange(2 ** 32) if seed is None else seed
+    rng = random.Random(seed)
+    previous = use_database(db_path)
+    try:
+        db.create_tables([Entry, WriteSequence], safe=True)
+        with db.atomic():
+            seed_rows = [dict(employee_name=SEED_EMPLOYEE, task_name=random_text(rng), task_time=rng.randint(1, 60),
+                              task_notes=random_text(rng, words=3), created_timestamp=random_timestamp(rng))
+                         for _ in range(seed_entries)]
+            for start in range(0, len(seed_rows), 100):
+                Entry.insert_many(seed_rows[start:start + 100]).execute()
+        model = dict((entry.id, entry_values(entry)) for entry in Entry.select())
+        db.close()
+
+        context = multiprocessing.get_context('spawn')
+        with context.Pool(workers) as pool:
+            results = pool.map(stress_worker, [(db_path, number, workers, ops_per_worker, stale_edits, seed)
+                                               for number in range(workers)])
+
+        failures = []
+        writes = []
+        lock_waits = []
+        op_counts = {}
+        for result in results:
+            writes.extend(result['writes'])
+            lock_waits.extend(result['lock_waits'])
+            for name, count in result['op_counts'].items():
+                op_counts[name] = op_counts.get(name, 0) + count
+        failures.extend(replay_writes(model, writes))
+
+        # no lost writes: every field of every surviving entry holds the last value written to it
+        stored = dict((entry.id, entry_values(entry)) for entry in Entry.select())
+        for entry_id in sorted(set(model) - set(stored)):
+            failures.append('entry {} was lost'.format(entry_id))
+        for entry_id in sorted(set(stored) - set(model)):
+            failures.append('deleted entry {} is still stored'.format(entry_id))
+        for entry_id in sorted(set(model) & set(stored)):
+            for field, value in sorted(model[entry_id].items()):
+                if stored[entry_id][field] != value:
+                    failures.append('entry {} {} is {!r} but was last set to {!r}'.format(
+                        entry_id, field, stored[entry_id][field], value))
+
+        # counts match, overall and per employee
+        if Entry.select().count() != len(model):
+            failures.append('{} entries stored, expected {}'.format(Entry.select().count(), len(model)))
+        for name in employee_names(workers):
+            count = len([values for values in model.values() if values['employee_name'] == name])
+            stored_count = Entry.select().where(Entry.employee_name == name).count()
+            if stored_count != count:
+                failures.append('{} has {} entries stored, expected {}'.format(name, stored_count, count))
+
+        # ConsoleUI lookups agree with a brute-force scan over the whole dataset
+        rows = list(model.values())
+        for _ in range(lookups):
+            description, method, inputs, predicate = choose_lookup(rng, employee_names(workers), rows)
+            found = set(entry.id for entry in run_lookup(method, inputs))
+            expected = set(entry_id for entry_id, values in model.items() if predicate(values))
+            if found != expected:
+                failures.append('lookup {}: missing {} unexpected {}'.format(description, sorted(expected - found),
+                                                                             sorted(found - expected)))
+        db.close()
+    finally:
+        restore_database(previous)
+
+    elapsed = max(result['finished'] for result in results) - min(result['started'] for result in results)
+    total_ops = sum(op_counts.values())
+    return {
+        'seed': seed,
+        'workers': workers,
+        'entries': len(model),
+        'op_counts': op_counts,
+        'elapsed': elapsed,
+        'throughput': total_ops / elapsed if elapsed else 0.0,
+        'lock_wait_percentiles': lock_wait_percentiles(lock_waits),
+        'failures': failures,
+    }
+
+
+def lock_wait_percentiles(lock_waits):
+    """Lock-wait latency percentiles in milliseconds"""
+    return [(label, percentile(lock_waits, percent) * 1000)
+            for label, percent in [('p50', 50), ('p90', 90), ('p99', 99), ('max', 100)]]
+
+
+def format_report(report):
+    """Formats a stress test report for the console"""
+    lines = ['Stress Test (seed {})'.format(report['seed']),
+             '=' * 24,
+             'Workers: {}'.format(report['workers']),
+             'Operations: {}'.format(', '.join('{} {}'.format(count, name)
+                                               for name, count in sorted(report['op_counts'].items()))),
+             'Entries at finish: {}'.format(report['entries']),
+             'Throughput: {:.1f} ops/sec over {:.2f} sec'.format(report['throughput'], report['elapsed']),
+             'Lock wait: {}'.format(', '.join('{} {:.2f}ms'.format(label, value)
+                                              for label, value in report['lock_wait_percentiles']))]
+    if report['failures']:
+        lines.append('{} invariant failures:'.format(len(report['failures'])))
+        lines.extend('  ' + failure for failure in report['failures'])
+    else:
+        lines.append('All invariants held')
+    return '\n'.join(lines)
+
+
+class TestConcurrentEntries(unittest.TestCase):
+    """Run Randomized Concurrent Operations against a Temporary Database"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.temp_dir, 'stress.db')
+
+    def test_concurrent_workers(self):
+        """Several processes editing the same entries should not lose or corrupt any of them"""
+        report = run_stress_test(self.db_path, workers=4, ops_per_worker=100, seed_entries=50, lookups=50)
+        self.assertEqual(report['failures'], [], format_report(report))
+        self.assertEqual(sum(report['op_counts'].values()), 400)
+
+    def test_large_dataset(self):
+        """Lookups should agree with a brute-force scan when there are many entries"""
+        report = run_stress_test(self.db_path, workers=2, ops_per_worker=50, seed_entries=2000, lookups=100)
+        self.assertEqual(report['failures'], [], format_report(report))
+        self.assertGreater(report['entries'], 1900)
+
+    def test_stale_edits(self):
+        """Saving an Entry loaded before a later edit puts back the old values, and nothing else goes wrong
+
+        Entry.save() writes every field, so the older copy undoes the later edit. A single worker with a fixed
+        seed makes the run repeatable; with this seed it saves two entries it opened before editing them again.
+        If Entry.save() stops overwriting later edits, this test fails and should become a regular no-failures
+        test.
+        """
+        report = run_stress_test(self.db_path, workers=1, ops_per_worker=200, seed_entries=5, lookups=20,
+                                 stale_edits=True, seed=3)
+        overwritten = set()
+        for failure in report['failures']:
+            match = re.match(r'entry (\d+) \w+ is .* but was last set to', failure)
+            if match:
+                overwritten.add(int(match.group(1)))
+        self.assertTrue(overwritten, format_report(report))
+        for failure in report['failures']:
+            if re.match(r'entry \d+ \w+ is .* but was last set to', failure):
+                continue
+            # a lookup may only disagree with the oracle about entries that were overwritten
+            self.assertTrue(failure.startswith('lookup '), format_report(report))
+            mismatched = set(int(entry_id) for entry_id in re.findall(r'\d+', failure.split(': ', 1)[1]))
+            self.assertLessEqual(mismatched, overwritten, format_report(report))
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Stress test the work log database')
+    parser.add_argument('--workers', type=int, default=4, help='number of worker processes')
+    parser.add_argument('--ops', type=int, default=500, help='operations per worker')
+    parser.add_argument('--seed-entries', type=int, default=0, help='entries to load before the workers start')
+    parser.add_argument('--lookups', type=int, default=200, help='lookups to check once the workers finish')
+    parser.add_argument('--stale-edits', action='store_true',
+                        help='also save and delete entries loaded before other edits, like the console app does')
+    parser.add_argument('--seed', type=int, help='random seed, to replay a failing run')
+    arguments = parser.parse_args()
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        stress_report = run_stress_test(os.path.join(temp_dir, 'stress.db'), workers=arguments.workers,
+                                        ops_per_worker=arguments.ops, seed_entries=arguments.seed_entries,
+                                        lookups=arguments.lookups, stale_edits=arguments.stale_edits,
+                                        seed=arguments.seed)
+    finally:
+        shutil.rmtree(temp_dir)
+    print(format_report(stress_report))
+    if stress_report['failures']:
+        raise SystemExit(1)